@@ -24,10 +24,11 @@ pip install \
   gpiozero \
   pillow \
   psutil \
+  numpy \
   requests
 
 # 4. Permissions
-sudo usermod -aG spi,gpio $USER
+sudo usermod -aG spi,gpio,video $USER
 
 # 5. Systemd service
 sudo tee /etc/systemd/system/st7789-dashboard.service > /dev/null << 'EOF'
@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
 # ST7789 172x320 RSDESIGN Color Dashboard (ALL-IN-ONE, STABLE)
 
-import os, time, socket, math, datetime
+import os, time, socket, math, datetime, threading, queue, glob, mmap
 import psutil, requests, spidev
+import numpy as np
 from gpiozero import DigitalOutputDevice
 from PIL import Image, ImageDraw, ImageFont
+from requests.adapters import HTTPAdapter
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 # ================= USER CONFIG =================
 WIDTH, HEIGHT = 172, 320
 X_OFFSET, Y_OFFSET = 34, 0
 SPI_BUS, SPI_DEV = 0, 0
-SPI_HZ = 24_000_000
+SPI_HZ = 40_000_000
 PAGE_TIME = 6.0
+WEATHER_REFRESH = 600.0
+WEATHER_RETRY = 60.0
 
 CITY = os.getenv("CITY", "Gig Harbor,US")
 UNITS = os.getenv("UNITS", "imperial")
@@ -21,14 +29,50 @@ ICON_DIR = "/home/ronseamon/weather_icons"
 DC_PIN = 25
 RST_PIN = 24
 
+# ================= FBTFT =================
+# If the kernel's fb_st7789v (fbtft) driver owns the panel, frames are
+# written to its mmap'd framebuffer and the kernel does the SPI/DMA.
+def find_fbtft():
+    for name in sorted(glob.glob("/sys/class/graphics/fb*/name")):
+        try:
+            if "st7789" in open(name).read():
+                return os.path.dirname(name)
+        except OSError:
+            pass
+    return None
+
+def check_fbtft(sysdir):
+    # fb_write() assumes a packed WIDTHxHEIGHT RGB565 framebuffer
+    def attr(n):
+        return open(os.path.join(sysdir, n)).read().strip()
+    geom = (attr("virtual_size"), attr("bits_per_pixel"), attr("stride"))
+    want = (f"{WIDTH},{HEIGHT}", "16", str(WIDTH*2))
+    if geom != want:
+        raise RuntimeError(
+            f"{sysdir}: framebuffer is {geom[0]} @ {geom[1]} bpp, stride {geom[2]}; "
+            f"expected {want[0]} @ 16 bpp, stride {want[2]} "
+            f"(set width={WIDTH},height={HEIGHT} on the fbtft overlay)")
+
+FB_SYS = find_fbtft()
+FB_DEV = None
+fb_mm = None
+if FB_SYS:
+    # fbtft holds the SPI device and pins, so spidev is no fallback here
+    check_fbtft(FB_SYS)
+    FB_DEV = "/dev/" + os.path.basename(FB_SYS)
+    _fb_fd = os.open(FB_DEV, os.O_RDWR)
+    fb_mm = mmap.mmap(_fb_fd, WIDTH*HEIGHT*2)
+
 # ================= SPI / GPIO =================
-spi = spidev.SpiDev()
-spi.open(SPI_BUS, SPI_DEV)
-spi.max_speed_hz = SPI_HZ
-spi.mode = 0
+# not available (and not needed) when fbtft has claimed spidev / DC / RST
+if fb_mm is None:
+    spi = spidev.SpiDev()
+    spi.open(SPI_BUS, SPI_DEV)
+    spi.max_speed_hz = SPI_HZ
+    spi.mode = 0
 
-dc = DigitalOutputDevice(DC_PIN)
-rst = DigitalOutputDevice(RST_PIN)
+    dc = DigitalOutputDevice(DC_PIN)
+    rst = DigitalOutputDevice(RST_PIN)
 
 # ================= ST7789 LOW LEVEL =================
 def cmd(c):
@@ -36,9 +80,16 @@ def cmd(c):
     spi.writebytes([c])
 
 def data(buf):
+    # writebytes2 takes any buffer and splits it into spidev bufsiz chunks itself
+    dc.on()
+    spi.writebytes2(buf)
+
+def cmd_data(c, buf):
+    # opcode + its arguments back to back: one DC low/high pair per command
+    dc.off()
+    spi.writebytes([c])
     dc.on()
-    for i in range(0, len(buf), 4096):
-        spi.writebytes2(buf[i:i+4096])
+    spi.writebytes2(buf)
 
 def reset():
     rst.on(); time.sleep(0.05)
@@ -46,36 +97,144 @@ def reset():
     rst.on(); time.sleep(0.15)
 
 def init_display():
+    if fb_mm is not None:
+        return
     reset()
     cmd(0x01); time.sleep(0.15)
     cmd(0x11); time.sleep(0.15)
-    cmd(0x3A); data(b"\x55")
-    cmd(0x36); data(b"\x08")
+    cmd_data(0x3A, b"\x55")
+    cmd_data(0x36, b"\x08")
     cmd(0x21)
     cmd(0x29)
 
-def window():
-    cmd(0x2A)
-    data(bytes([0, X_OFFSET, 0, X_OFFSET + WIDTH - 1]))
-    cmd(0x2B)
-    data(bytes([0, Y_OFFSET, (HEIGHT-1)>>8, (HEIGHT-1)&0xFF]))
+# column range never changes, only the row span does
+CASET = bytes([X_OFFSET>>8, X_OFFSET&0xFF, (X_OFFSET+WIDTH-1)>>8, (X_OFFSET+WIDTH-1)&0xFF])
+
+def window(y0=0, y1=HEIGHT-1):
+    y0 += Y_OFFSET
+    y1 += Y_OFFSET
+    cmd_data(0x2A, CASET)
+    cmd_data(0x2B, bytes([y0>>8, y0&0xFF, y1>>8, y1&0xFF]))
     cmd(0x2C)
 
-def rgb565(img):
-    raw = img.tobytes()
-    out = bytearray(len(raw)//3 * 2)
-    j = 0
-    for i in range(0, len(raw), 3):
-        r, g, b = raw[i:i+3]
-        v = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
-        out[j] = v >> 8
-        out[j+1] = v & 0xFF
-        j += 2
+# PIL packs BGR;16 in C; byteswapped it is the ST7789 RGB565 wire format.
+# Pillow 12 dropped the mode, so fall back to NumPy packing there.
+try:
+    Image.new("RGB", (1, 1)).convert("BGR;16")
+    HAS_BGR16 = True
+except ValueError:
+    HAS_BGR16 = False
+
+# Without BGR;16, a Numba-compiled packer (optional dependency) writes
+# straight into the output buffer; plain NumPy is the last resort.
+if njit:
+    @njit(parallel=True, cache=True)
+    def pack565(rgb, out):
+        h, w, _ = rgb.shape
+        for y in prange(h):
+            for x in range(w):
+                r = rgb[y, x, 0]; g = rgb[y, x, 1]; b = rgb[y, x, 2]
+                i = 2 * (y*w + x)
+                out[i] = (r & 0xF8) | (g >> 5)
+                out[i+1] = ((g & 0x1C) << 3) | (b >> 3)
+
+# per-channel RGB565 contributions, indexed by the 8-bit channel value
+_lut = np.arange(256, dtype=np.uint16)
+LUT_R = (_lut & 0xF8) << 8
+LUT_G = (_lut & 0xFC) << 3
+LUT_B = _lut >> 3
+
+def to_rgb565(img, out):
+    dst = np.frombuffer(out, ">u2")
+    if HAS_BGR16:
+        dst[:] = np.frombuffer(img.convert("BGR;16").tobytes(), "<u2")
+        return out
+    # pages always hand us RGB; convert() would copy the frame regardless
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if njit:
+        pack565(np.asarray(img), np.frombuffer(out, np.uint8))
+        return out
+    arr = np.asarray(img)
+    dst.reshape(HEIGHT, WIDTH)[:] = LUT_R[arr[..., 0]] | LUT_G[arr[..., 1]] | LUT_B[arr[..., 2]]
     return out
 
+# ================= FRAMEBUFFERS =================
+# allocated once and reused by every page / push
+FB = Image.new("RGB", (WIDTH, HEIGHT), (0,0,0))
+# packed frames, used round-robin. push() diffs against the previous one
+# so only changed rows are queued; packing overlaps the transfer of the
+# frames before it.
+FB565 = [bytearray(WIDTH*HEIGHT*2) for _ in range(3)]
+# set while a buffer is neither queued nor on the wire; push() waits on it
+# before repacking, so a buffer in flight is never overwritten
+_fb_free = [threading.Event() for _ in FB565]
+for _ev in _fb_free:
+    _ev.set()
+_frame = 0
+_tx_q = queue.Queue(maxsize=1)
+# set by tx_worker() if SPI fails; push() re-raises it so the process
+# exits (and systemd restarts it) instead of blocking on a dead queue
+_tx_error = None
+
+def tx_worker():
+    # only this thread touches SPI / DC (or the fbtft framebuffer) after init
+    global _tx_error
+    try:
+        while True:
+            i, y0, y1, buf = _tx_q.get()
+            if fb_mm is not None:
+                fb_write(y0, y1, buf)
+            else:
+                window(y0, y1)
+                data(buf)
+            _fb_free[i].set()
+    except BaseException as e:
+        _tx_error = e
+        raise
+
+def tx_check():
+    if _tx_error is not None:
+        raise RuntimeError("SPI transmit thread failed") from _tx_error
+
+def fb_write(y0, y1, buf):
+    # fbtft framebuffers are native little-endian RGB565
+    fb = np.frombuffer(fb_mm, "<u2")
+    fb[y0*WIDTH:(y1+1)*WIDTH] = np.frombuffer(buf, ">u2")
+
 def push(img):
-    window()
-    data(rgb565(img))
+    global _frame
+    i = _frame % 3
+    while not _fb_free[i].wait(1.0):
+        tx_check()
+    tx_check()
+    buf = FB565[i]
+    to_rgb565(img, buf)
+    mv = memoryview(buf)
+    item = None
+    if _frame == 0:
+        item = (i, 0, HEIGHT-1, mv)
+    else:
+        prev = FB565[(_frame-1) % 3]
+        diff = np.frombuffer(buf, np.uint8) != np.frombuffer(prev, np.uint8)
+        rows = np.nonzero(diff.reshape(HEIGHT, WIDTH*2).any(1))[0]
+        if rows.size:
+            y0, y1 = int(rows[0]), int(rows[-1])
+            item = (i, y0, y1, mv[y0*WIDTH*2:(y1+1)*WIDTH*2])
+    if item:
+        _fb_free[i].clear()
+        while True:
+            try:
+                _tx_q.put(item, timeout=1.0)
+                break
+            except queue.Full:
+                tx_check()
+    _frame += 1
+
+def clear_fb():
+    d = ImageDraw.Draw(FB)
+    d.rectangle([0, 0, WIDTH, HEIGHT], fill=(0,0,0))
+    return d
 
 # ================= UTIL =================
 def ip():
@@ -108,11 +267,15 @@ def grad(p):
     return (255, int(255*(1-(p-0.5)*2)), 0)
 
 # ================= WEATHER =================
+# keep-alive session so refreshes reuse the TLS connection to OWM
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2))
+
 def fetch_weather():
     if not OWM_API_KEY:
         return None
     try:
-        r = requests.get(
+        r = SESSION.get(
             "https://api.openweathermap.org/data/2.5/weather",
             params={"q": CITY, "appid": OWM_API_KEY, "units": UNITS},
             timeout=8
@@ -123,65 +286,129 @@ def fetch_weather():
     except:
         return None
 
-def load_weather_icon(code):
+# filled by weather_worker(); pages only read it
+_weather = {"cur": None, "ts": 0}
+_weather_lock = threading.Lock()
+
+def weather_worker():
+    while True:
+        w = fetch_weather()
+        if w:
+            with _weather_lock:
+                _weather.update(cur=w, ts=time.time())
+        # retry soon after a failure (e.g. network not up yet at boot)
+        time.sleep(WEATHER_REFRESH if w else WEATHER_RETRY)
+
+# decoded + resized icons by (code, size); only a handful of OWM codes exist
+_ICON_CACHE = {}
+
+def load_weather_icon(code, size):
+    key = (code, size)
+    if key in _ICON_CACHE:
+        return _ICON_CACHE[key]
     path = os.path.join(ICON_DIR, f"{code}.png")
-    if not os.path.exists(path):
-        return None
-    return Image.open(path).convert("RGBA")
+    icon = None
+    if os.path.exists(path):
+        icon = Image.open(path).convert("RGBA").resize((size, size), Image.LANCZOS)
+    _ICON_CACHE[key] = icon
+    return icon
 
 # ================= FONTS =================
 FONT_L = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 22)
 FONT_M = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 16)
 FONT_S = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 13)
 
+# ================= LABELS =================
+# Static strings are rasterized once to an "L" coverage mask and pasted
+# with their colour, which is what draw.text() does after shaping.
+def make_label(text, font, fill):
+    _, _, r, b = font.getbbox(text)
+    mask = Image.new("L", (max(r, 1), max(b, 1)), 0)
+    ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=255)
+    return mask, fill, font.getlength(text)
+
+LABELS = {
+    "RSDESIGN": make_label("RSDESIGN", FONT_L, (255,255,255)),
+    "STATUS": make_label("STATUS", FONT_L, (255,255,255)),
+    "WEATHER": make_label("WEATHER", FONT_L, (255,255,255)),
+    "CITY": make_label(CITY.upper(), FONT_M, (180,180,180)),
+    "CPU": make_label("CPU", FONT_S, (200,200,200)),
+    "RAM": make_label("RAM", FONT_S, (200,200,200)),
+}
+
+# ring percentages only use these characters, so they are composited
+# glyph by glyph from pre-rendered masks
+GLYPHS = {c: make_label(c, FONT_M, (255,255,255)) for c in "0123456789%"}
+
+# center=True centres the text advance on x, like draw.text(anchor="ma");
+# the top placement is the same as the default anchor
+def paste_label(img, xy, key, center=False):
+    mask, fill, adv = LABELS[key]
+    x, y = xy
+    if center:
+        x = int(x - adv / 2)
+    img.paste(fill, (x, y, x+mask.width, y+mask.height), mask)
+
+def paste_glyphs(img, xy, s, center=False):
+    x, y = xy
+    if center:
+        x -= sum(GLYPHS[c][2] for c in s) / 2
+    for c in s:
+        mask, fill, adv = GLYPHS[c]
+        img.paste(fill, (int(x), y, int(x)+mask.width, y+mask.height), mask)
+        x += adv
+
 # ================= DRAW HELPERS =================
-def ring(draw, cx, cy, r, w, pct, label):
+def ring(img, draw, cx, cy, r, w, pct, label):
     col = grad(pct)
     draw.ellipse([cx-r, cy-r, cx+r, cy+r], outline=(80,80,80), width=2)
     sweep = int(360 * pct / 100)
-    for i in range(w):
-        draw.arc([cx-r+i, cy-r+i, cx+r-i, cy+r-i], -90, -90+sweep, fill=col)
-    draw.text((cx-20, cy-10), f"{int(pct)}%", font=FONT_M, fill=(255,255,255))
-    draw.text((cx-18, cy+14), label, font=FONT_S, fill=(200,200,200))
+    draw.arc([cx-r, cy-r, cx+r, cy+r], -90, -90+sweep, fill=col, width=w)
+    paste_glyphs(img, (cx, cy-10), f"{int(pct)}%", center=True)
+    paste_label(img, (cx, cy+14), label, center=True)
 
 # ================= PAGES =================
 def page_perf():
-    img = Image.new("RGB", (WIDTH, HEIGHT), (0,0,0))
-    d = ImageDraw.Draw(img)
+    img = FB
+    d = clear_fb()
 
-    d.text((10,6), "RSDESIGN", font=FONT_L, fill=(255,255,255))
-    ring(d, WIDTH//2, 110, 56, 10, psutil.cpu_percent(), "CPU")
-    ring(d, WIDTH//2, 220, 56, 10, psutil.virtual_memory().percent, "RAM")
+    paste_label(img, (10,6), "RSDESIGN")
+    ring(img, d, WIDTH//2, 110, 56, 10, psutil.cpu_percent(), "CPU")
+    ring(img, d, WIDTH//2, 220, 56, 10, psutil.virtual_memory().percent, "RAM")
 
     return img
 
 def page_status():
-    img = Image.new("RGB", (WIDTH, HEIGHT), (0,0,0))
-    d = ImageDraw.Draw(img)
+    img = FB
+    d = clear_fb()
 
-    d.text((10,6), "STATUS", font=FONT_L, fill=(255,255,255))
+    paste_label(img, (10,6), "STATUS")
     d.text((10,60), f"IP  {ip()}", font=FONT_M, fill=(200,200,200))
     d.text((10,90), f"UP  {uptime()}", font=FONT_M, fill=(200,200,200))
     d.text((10,120), f"TEMP {temp()}", font=FONT_M, fill=(200,200,200))
 
     return img
 
-def page_weather():
-    img = Image.new("RGB", (WIDTH, HEIGHT), (0,0,0))
+# weather page only changes when weather_worker() stores new data, so it
+# is rendered once per refresh into its own image and reused until then
+WEATHER_IMG = Image.new("RGB", (WIDTH, HEIGHT), (0,0,0))
+_weather_img_ts = None
+
+def render_weather(w):
+    img = WEATHER_IMG
     d = ImageDraw.Draw(img)
+    d.rectangle([0, 0, WIDTH, HEIGHT], fill=(0,0,0))
 
-    d.text((10,6), "WEATHER", font=FONT_L, fill=(255,255,255))
-    d.text((10,34), CITY.upper(), font=FONT_M, fill=(180,180,180))
+    paste_label(img, (10,6), "WEATHER")
+    paste_label(img, (10,34), "CITY")
 
-    w = fetch_weather()
     if not w:
         d.text((20,150), "Weather unavailable", font=FONT_M, fill=(200,0,0))
         return img
 
     icon_code = w["weather"][0]["icon"]
-    icon = load_weather_icon(icon_code)
+    icon = load_weather_icon(icon_code, 80)
     if icon:
-        icon = icon.resize((80,80), Image.LANCZOS)
         img.paste(icon, (46, 60))
 
     t = int(w["main"]["temp"])
@@ -194,9 +421,20 @@ def page_weather():
 
     return img
 
+def page_weather():
+    global _weather_img_ts
+    with _weather_lock:
+        w, ts = _weather["cur"], _weather["ts"]
+    if ts != _weather_img_ts:
+        render_weather(w)
+        _weather_img_ts = ts
+    return WEATHER_IMG
+
 # ================= MAIN =================
 init_display()
 psutil.cpu_percent()
+threading.Thread(target=tx_worker, daemon=True).start()
+threading.Thread(target=weather_worker, daemon=True).start()
 
 pages = [page_perf, page_status, page_weather]
 idx = 0